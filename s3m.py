@@ -21,11 +21,15 @@ S3M - sqlite3 wrapper for multithreaded applications
 # You should have received a copy of the GNU General Public License
 # along with this library. If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import os
 import sqlite3
 import threading
+import urllib.parse
 import weakref
 
+from threading import get_ident
+
 __all__ = ["connect", "Connection", "Cursor", "S3MError", "LockTimeoutError"]
 
 __version__ = "1.1.0"
@@ -36,6 +40,21 @@ DB_STATES = {}
 # Locks access to DB_STATES
 DICT_LOCK = threading.Lock()
 
+# Largest value accepted by PRAGMA busy_timeout (in milliseconds)
+MAX_BUSY_TIMEOUT = 2147483647
+
+# Maximum amount of time (in seconds) the constructor waits to enable the WAL journal mode
+WAL_SETUP_TIMEOUT = 0.5
+
+# Transaction control statements
+TRANSACTION_KEYWORDS = frozenset(("BEGIN", "COMMIT", "ROLLBACK", "END"))
+
+# Characters such a statement can start with (including leading whitespace)
+TRANSACTION_STARTS = frozenset("BbCcRrEe \t\r\n")
+
+# Size (in bytes) the WAL file is truncated to when SQLite restarts it after a checkpoint
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
 class S3MError(Exception):
     """The base class of all the other exceptions in this module"""
     pass
@@ -45,7 +64,8 @@ class LockTimeoutError(S3MError):
 
     def __init__(self, conn, msg=None):
         if msg is None:
-            if conn is None or not isinstance(conn.lock_timeout, (int, float)):
+            # -1 means SQLite's busy timeout was exceeded, not lock_timeout
+            if conn is None or not isinstance(conn.lock_timeout, (int, float)) or conn.lock_timeout == -1:
                 msg = "Lock timeout exceeded"
             else:
                 msg = "Lock timeout exceeded (> %s)" % (conn.lock_timeout)
@@ -54,8 +74,10 @@ class LockTimeoutError(S3MError):
 
         self.connection = conn
 
-def normalize_path(path):
+def normalize_path(path, uri=False):
     """
+    Normalize a database path, `uri` tells whether it's to be opened as a URI.
+
     >>> normalize_path("/a/b/c/")
     '/a/b/c'
     >>> normalize_path("/a/b/c")
@@ -68,20 +90,126 @@ def normalize_path(path):
     '/a/b/c'
     >>> normalize_path(":memory:")
     ':memory:'
+    >>> normalize_path("file:///a/./b/../c%20d.db?mode=ro", uri=True)
+    'file:/a/c%20d.db?mode=ro'
+    >>> normalize_path("file::memory:?cache=shared", uri=True)
+    'file::memory:?cache=shared'
+    >>> normalize_path("file:test?mode=memory&cache=shared", uri=True)
+    'file:test?mode=memory&cache=shared'
+    >>> normalize_path("/a/file:b")
+    '/a/file:b'
     """
+
     if path == ":memory:":
         return path
 
+    # URIs are connect strings, only their path part is a filesystem path
+    if uri and isinstance(path, str) and path.startswith("file:"):
+        parts = urllib.parse.urlsplit(path)
+        mode = urllib.parse.parse_qs(parts.query).get("mode")
+
+        # In-memory databases are named rather than located
+        if parts.path in ("", ":memory:") or mode == ["memory"]:
+            return path
+
+        path = "file:" + urllib.parse.quote(normalize_path(urllib.parse.unquote(parts.path)))
+
+        return path + "?" + parts.query if parts.query else path
+
+    # Not cached: the result is the path that gets opened, symlinks in it may be repointed at any time
     return os.path.normcase(os.path.normpath(os.path.realpath(path)))
 
-class FakeLock(object):
-    """Only pretends to be a lock, doesn't do anything"""
+def database_path(path):
+    """
+    Get the path of the database file from a normalized path, used to look up the database state.
+
+    >>> database_path("file:/a/c%20d.db?mode=ro")
+    '/a/c d.db'
+    >>> database_path("/a/c.db")
+    '/a/c.db'
+    >>> database_path("file::memory:?cache=shared")
+    'file::memory:?cache=shared'
+    """
+
+    if not isinstance(path, str) or not path.startswith("file:/"):
+        return path
+
+    return urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+
+def is_select(sql):
+    """
+    >>> is_select("SELECT * FROM a")
+    True
+    >>> is_select("  \\n select 1")
+    True
+    >>> is_select("INSERT INTO a VALUES(1)")
+    False
+    >>> is_select("BEGIN TRANSACTION")
+    False
+    """
+
+    return sql.lstrip()[:6].upper() == "SELECT"
+
+def immediate_begin(sql):
+    """
+    Turn a plain BEGIN statement into BEGIN IMMEDIATE, other statements are returned unchanged.
+
+    >>> immediate_begin("BEGIN")
+    'BEGIN IMMEDIATE'
+    >>> immediate_begin(" begin transaction; ")
+    'BEGIN IMMEDIATE TRANSACTION'
+    >>> immediate_begin("BEGIN DEFERRED")
+    'BEGIN DEFERRED'
+    >>> immediate_begin("INSERT INTO a VALUES(1)")
+    'INSERT INTO a VALUES(1)'
+    """
 
-    def acquire(self, *args, **kwargs):
-        return True
+    if sql.lstrip()[:5].upper() != "BEGIN":
+        return sql
 
-    def release(self, *args, **kwargs):
-        return True
+    tokens = sql.strip().rstrip(";").upper().split()
+
+    if tokens == ["BEGIN"]:
+        return "BEGIN IMMEDIATE"
+
+    if tokens == ["BEGIN", "TRANSACTION"]:
+        return "BEGIN IMMEDIATE TRANSACTION"
+
+    return sql
+
+def transaction_keyword(sql):
+    """
+    Get the keyword of a transaction control statement, `None` for other statements.
+
+    >>> transaction_keyword("COMMIT")
+    'COMMIT'
+    >>> transaction_keyword(" end transaction")
+    'END'
+    >>> transaction_keyword("begin;")
+    'BEGIN'
+    >>> transaction_keyword("INSERT INTO a VALUES(1)") is None
+    True
+    >>> transaction_keyword("CREATE TABLE a(id INTEGER)") is None
+    True
+    """
+
+    # Most statements are rejected by the first character alone
+    if not sql or sql[0] not in TRANSACTION_STARTS:
+        return None
+
+    tokens = sql.split(None, 1)
+
+    if not tokens:
+        return None
+
+    keyword = tokens[0].rstrip(";").upper()
+
+    return keyword if keyword in TRANSACTION_KEYWORDS else None
+
+def is_busy_error(exc):
+    """Check if the exception means that SQLite's busy timeout was exceeded"""
+
+    return isinstance(exc, sqlite3.OperationalError) and str(exc).startswith("database is locked")
 
 class DBState(object):
     """Stores database locks and the currently active connection"""
@@ -94,22 +222,75 @@ class DBState(object):
         self.transaction_lock = threading.Lock()
         self.active_connection = connection
 
+        # Has the WAL journal mode been enabled for the database?
+        self.wal_enabled = False
+
+        # Runs the asynchronous commits, one at a time (created on demand)
+        self.commit_executor = None
+
 class FakeDBState(object):
-    """Like DBState but uses FakeLock"""
+    """Like DBState but without any locks"""
 
     def __init__(self, connection=None):
-        self.lock = FakeLock()
-        self.transaction_lock = FakeLock()
+        self.lock = None
+        self.transaction_lock = None
         self.active_connection = None
+        self.wal_enabled = False
+        self.commit_executor = None
 
-def chain(f):
-    def wrapper(self, *args, **kwargs):
-        f(self, *args, **kwargs)
-        return self
+def _remove_db_state(path):
+    with DICT_LOCK:
+        finalizer = DB_STATES.get(path)
+
+        # The entry might have already been replaced by a new one
+        if finalizer is not None and not finalizer.alive:
+            DB_STATES.pop(path)
+
+def get_db_state(path):
+    """Get the shared DBState of the database, create a new one if necessary"""
+
+    # Fast path: the state already exists, no need to take DICT_LOCK
+    finalizer = DB_STATES.get(path)
+    info = None if finalizer is None else finalizer.peek()
+
+    if info is not None:
+        return info[0]
+
+    with DICT_LOCK:
+        finalizer = DB_STATES.get(path)
+        info = None if finalizer is None else finalizer.peek()
+
+        if info is not None:
+            return info[0]
+
+        # Either there's no state or it's dead and is about to be removed
+        db_state = DBState()
 
-    wrapper.__doc__ = f.__doc__
+        # Automatically cleanup DB_STATES
+        DB_STATES[path] = weakref.finalize(db_state, _remove_db_state, path)
 
-    return wrapper
+        return db_state
+
+def _close_resources(connection, db_state_ref):
+    """Close the sqlite3 connection.
+       Doesn't reference the :any:`Connection` object so it can be used with :any:`weakref.finalize`.
+    """
+
+    db_state = db_state_ref()
+
+    # :memory: databases don't have locks
+    if db_state is None or db_state.lock is None:
+        connection.close()
+        return
+
+    # Let SQLite refresh the query planner statistics, recommended before closing the connection
+    try:
+        if not connection.in_transaction:
+            connection.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass
+
+    connection.close()
 
 class Cursor(object):
     """The cursor class, analogous to :any:`sqlite3.Cursor`."""
@@ -121,11 +302,17 @@ class Cursor(object):
 
         self._cursor = connection.connection.cursor()
 
+        connection._all_cursors.add(self)
+
     def __enter__(self):
         self.connection.acquire()
 
-    def __exit__(self, *args, **kwargs):
-        self.connection.release()
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.connection
+        connection.release()
+
+        if is_busy_error(exc_value):
+            raise LockTimeoutError(connection) from exc_value
 
     def __del__(self):
         self.close()
@@ -133,33 +320,60 @@ class Cursor(object):
     def close(self):
         """Close the cursor"""
 
-        if self.closed or self.connection.closed:
+        connection = self.connection
+
+        if self.closed or connection is None or connection.closed:
             return
 
         self._cursor.close()
         self.closed = True
 
-    @chain
-    def execute(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.execute`
+    def execute(self, sql, parameters=None):
+        """Analogous to :any:`sqlite3.Cursor.execute`.
+           SELECT statements don't acquire the locks, so closing the connection from another thread
+           while one is running may make it fail with :any:`sqlite3.ProgrammingError`.
+           If the connection locks transactions, a plain BEGIN is executed as BEGIN IMMEDIATE.
 
            :returns: self
         """
 
+        if is_select(sql):
+            # Same as __exit__() would do, the locks just aren't needed
+            try:
+                if parameters is None:
+                    self._cursor.execute(sql)
+                else:
+                    self._cursor.execute(sql, parameters)
+            except sqlite3.OperationalError as e:
+                if is_busy_error(e):
+                    raise LockTimeoutError(self.connection) from e
+
+                raise
+
+            return self
+
+        if self.connection.lock_transactions and transaction_keyword(sql) == "BEGIN":
+            sql = immediate_begin(sql)
+
         with self:
-            self._cursor.execute(*args, **kwargs)
+            if parameters is None:
+                self._cursor.execute(sql)
+            else:
+                self._cursor.execute(sql, parameters)
+
+        return self
 
-    @chain
-    def executemany(self, *args, **kwargs):
+    def executemany(self, sql, seq_of_parameters):
         """Analogous to :any:`sqlite3.Cursor.executemany`
 
            :returns: self
         """
 
         with self:
-            self._cursor.executemany(*args, **kwargs)
+            self._cursor.executemany(sql, seq_of_parameters)
+
+        return self
 
-    @chain
     def executescript(self, *args, **kwargs):
         """Analogous to :any:`sqlite3.Cursor.executescript`
 
@@ -169,23 +383,73 @@ class Cursor(object):
         with self:
             self._cursor.executescript(*args, **kwargs)
 
+        return self
+
+    def execute_batch(self, statements):
+        """Execute multiple statements (without parameters) as a single script,
+           acquiring the locks only once. Like :any:`Cursor.executescript`,
+           it commits the pending transaction first.
+           If the connection locks transactions, a plain BEGIN is executed as BEGIN IMMEDIATE.
+
+           :param statements: sequence of SQL statements
+           :returns: self
+        """
+
+        script = []
+
+        for sql in statements:
+            if self.connection.lock_transactions and transaction_keyword(sql) == "BEGIN":
+                sql = immediate_begin(sql)
+
+            script.append(sql)
+
+        with self:
+            # The separator goes on its own line so that a trailing -- comment can't swallow it
+            self._cursor.executescript("\n;\n".join(script))
+
+        return self
+
+    def executemany_fast(self, sql, seq_of_parameters):
+        """Like :any:`Cursor.executemany` but acquires the locks only once
+           and runs all the statements in a single transaction.
+           If a transaction is already active, it will be used instead.
+
+           :returns: self
+        """
+
+        with self:
+            connection = self.connection.connection
+
+            if connection.in_transaction:
+                self._cursor.executemany(sql, seq_of_parameters)
+                return self
+
+            self._cursor.execute("BEGIN IMMEDIATE" if self.connection.lock_transactions else "BEGIN")
+
+            try:
+                self._cursor.executemany(sql, seq_of_parameters)
+            except BaseException:
+                connection.rollback()
+                raise
+
+            connection.commit()
+
+        return self
+
     def fetchone(self):
         """Analogous to :any:`sqlite3.Cursor.fetchone`"""
 
-        with self:
-            return self._cursor.fetchone()
+        return self._cursor.fetchone()
 
     def fetchmany(self, *args, **kwargs):
         """Analogous to :any:`sqlite3.Cursor.fetchmany`"""
 
-        with self:
-            return self._cursor.fetchmany(*args, **kwargs)
+        return self._cursor.fetchmany(*args, **kwargs)
 
     def fetchall(self):
         """Analogous to :any:`sqlite3.Cursor.fetchall`"""
 
-        with self:
-            return self._cursor.fetchall()
+        return self._cursor.fetchall()
 
     @property
     def rowcount(self):
@@ -223,6 +487,7 @@ class Cursor(object):
 
 class Connection(object):
     """The connection class. It won't let multiple database operations execute in parallel.
+       SELECT statements are the exception: they don't acquire the locks, SQLite handles them on its own.
        It can also block parallel transactions (with lock_transactions=True).
 
        `with` statement is also supported, it acquires the locks, thus blocking all the competing threads.
@@ -232,24 +497,38 @@ class Connection(object):
        :param lock_transactions: If True, parallel transactions will be blocked
        :param lock_timeout: Maximum amount of time the connection is allowed to wait for a lock.
                             If the timeout is exceeded, LockTimeoutError will be thrown.
-                            -1 disables the timeout.
-       :param single_cursor_mode: Use only one cursor (default: `False`)
+                            It also sets SQLite's busy timeout (unless `timeout` is passed explicitly),
+                            LockTimeoutError is thrown when that one is exceeded too.
+                            -1 disables the timeout (SQLite's busy timeout is then left
+                            to `sqlite3.connect`, 5 seconds by default).
+       :param single_cursor_mode: Use only one cursor per thread (default: `False`)
     """
 
-    def __init__(self, path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False, *args, **kwargs):
-        self.path = normalize_path(path)
+    def __init__(self, path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False,
+                 *args, **kwargs):
+        # uri is the 7th positional argument of sqlite3.connect() after the path
+        uri = args[6] if len(args) > 6 else kwargs.get("uri", False)
+        self.path = normalize_path(path, uri)
+
+        # The 4th one is check_same_thread
+        self._check_same_thread = args[3] if len(args) > 3 else kwargs.get("check_same_thread", True)
         self.connection = None
-        self._cursor = None
         self.closed = False
         self.db_state = None
         self.single_cursor_mode = single_cursor_mode
 
+        # In single cursor mode each thread gets its own cursor
+        self._cursors = threading.local()
+
+        # All the cursors, they are closed together with the connection
+        self._all_cursors = weakref.WeakSet()
+
+        # Closes the sqlite3 connection if close() wasn't called
+        self._finalizer = None
+
         # Maximum amount of time the connection is allowed to wait when acquiring the lock.
         self.lock_timeout = lock_timeout
 
-        # Used in with block
-        self.was_in_transaction = False
-
         # Should parallel transactions be allowed?
         self.lock_transactions = lock_transactions
 
@@ -259,42 +538,128 @@ class Connection(object):
         # Number of active with blocks
         self.with_count = 0
 
+        # Thread that holds the locks, lock_transactions of its outermost acquire() call
+        # and the stack of the nested calls: lock_transactions for the ones that
+        # actually acquired the locks, None for the rest. Only the owner thread touches these
+        self._owner = None
+        self._owner_lock_transactions = False
+        self._nested = []
+
         if self.path == ":memory:":
             # No two :memory: connections point to the same database => locks are not needed
             self.db_state = FakeDBState()
         else:
-            with DICT_LOCK:
-                self.db_state = DB_STATES.get(self.path)
+            # Plain paths and URIs pointing to the same file share the state
+            self.db_state = get_db_state(database_path(self.path))
 
-                # If the object doesn't already exist, make a new one
-                if self.db_state is None:
-                    self.db_state = DBState()
+        self.connection = sqlite3.connect(self.path, *args, **kwargs)
 
-                    def func(path):
-                        with DICT_LOCK:
-                            DB_STATES.pop(path)
+        self._finalizer = weakref.finalize(self, _close_resources, self.connection,
+                                           weakref.ref(self.db_state))
 
-                    # Automatically cleanup DB_STATES
-                    DB_STATES[self.path] = weakref.finalize(self.db_state, func, self.path)
-                else:
-                    self.db_state = self.db_state.peek()[0]
+        # Let SQLite itself wait for the competing readers/writers,
+        # unless the timeout was explicitly specified.
+        # Without lock_timeout sqlite3's own default timeout is kept, waiting forever is never the answer
+        if not args and "timeout" not in kwargs and lock_timeout != -1:
+            busy_timeout = min(int(lock_timeout * 1000), MAX_BUSY_TIMEOUT)
 
-        self.connection = sqlite3.connect(self.path, *args, **kwargs)
+            self.connection.execute("PRAGMA busy_timeout=%d" % busy_timeout)
 
-        if self.single_cursor_mode:
-            self._cursor = Cursor(self)
+        if self.path != ":memory:":
+            self._setup_wal()
+
+    def _setup_wal(self):
+        """Enable the WAL journal mode so that readers don't block the writer.
+           Gives up after :any:`WAL_SETUP_TIMEOUT`, the next connection will try again.
+        """
+
+        db_state = self.db_state
+
+        # journal_mode is persistent, it only needs to be set once per database
+        if not db_state.wal_enabled:
+            timeout = WAL_SETUP_TIMEOUT
+
+            if self.lock_timeout != -1:
+                timeout = min(timeout, self.lock_timeout)
+
+            # The transaction lock is not needed (and could be held by another connection of this thread),
+            # the database lock is enough to keep the other connections from running statements meanwhile
+            if not db_state.lock.acquire(timeout=timeout):
+                return
+
+            try:
+                if not db_state.wal_enabled:
+                    db_state.wal_enabled = self._enable_wal(timeout)
+            finally:
+                db_state.lock.release()
+
+            if not db_state.wal_enabled:
+                return
+
+        # synchronous, however, is a per-connection setting.
+        # NORMAL is only safe in the WAL mode, rollback journals need FULL
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        # SQLite checkpoints the WAL file on its own (see wal_autocheckpoint) but never shrinks it,
+        # without the limit it stays as large as the largest transaction ever made
+        self.connection.execute("PRAGMA journal_size_limit=%d" % JOURNAL_SIZE_LIMIT)
+
+    def _enable_wal(self, timeout):
+        """Switch the database to the WAL journal mode, waiting at most `timeout` seconds for other processes.
+
+           :returns: `True` if the database is in the WAL mode
+        """
+
+        busy_timeout = self.connection.execute("PRAGMA busy_timeout").fetchone()[0]
+        self.connection.execute("PRAGMA busy_timeout=%d" % int(timeout * 1000))
+
+        try:
+            # SQLite may decline the switch without raising (e.g. in-memory databases stay in "memory")
+            journal_mode = self.connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        except sqlite3.OperationalError:
+            # E.g. the database is read-only or locked by another process, the journal mode stays unchanged
+            return False
+        finally:
+            self.connection.execute("PRAGMA busy_timeout=%d" % busy_timeout)
+
+        return journal_mode.lower() == "wal"
 
     def cursor(self):
         """Analogous to :any:`sqlite3.Connection.cursor`"""
 
         if self.single_cursor_mode:
-            if self._cursor is None:
-                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
-
             return self._cursor
 
         return Cursor(self)
 
+    @property
+    def _cursor(self):
+        """The cursor of the current thread (used in single cursor mode)"""
+
+        cursor = getattr(self._cursors, "cursor", None)
+
+        if cursor is None:
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+            cursor = Cursor(self)
+            self._cursors.cursor = cursor
+
+        return cursor
+
+    @property
+    def lock_timeout(self):
+        """Maximum amount of time the connection is allowed to wait when acquiring the lock"""
+
+        return self._lock_timeout
+
+    @lock_timeout.setter
+    def lock_timeout(self, value):
+        self._lock_timeout = value
+
+        # Computed once so that acquire() doesn't have to deal with -1 every time
+        self._acquire_kwargs = {} if value == -1 else {"timeout": value}
+
     @property
     def in_transaction(self):
         """Analogous to :any:`sqlite3.Connection.in_transaction`"""
@@ -339,9 +704,12 @@ class Connection(object):
     def __enter__(self):
         self.acquire()
 
-    def __exit__(self, *args, **kwargs):
+    def __exit__(self, exc_type, exc_value, traceback):
         self.release()
 
+        if is_busy_error(exc_value):
+            raise LockTimeoutError(self) from exc_value
+
     def acquire(self, lock_transactions=None):
         """
             Acquire the connection locks.
@@ -350,75 +718,92 @@ class Connection(object):
                                       (`self.lock_transactions` is the default value)
         """
 
-        if not self.personal_lock.acquire(timeout=self.lock_timeout):
-            raise LockTimeoutError(self)
-
-        self.with_count += 1
-
         if lock_transactions is None:
             lock_transactions = self.lock_transactions
 
-        if lock_transactions and self.db_state.active_connection is not self:
-            if not self.db_state.transaction_lock.acquire(timeout=self.lock_timeout):
-                self.personal_lock.release()
-                raise LockTimeoutError(self)
+        ident = get_ident()
 
-            self.db_state.active_connection = self
+        # The current thread already holds the locks, no need to acquire them again
+        if self._owner == ident:
+            if not lock_transactions or self._owner_lock_transactions or True in self._nested:
+                self._nested.append(None)
+                return
 
-        if not self.db_state.lock.acquire(timeout=self.lock_timeout):
-            self.personal_lock.release()
+        if not self.personal_lock.acquire(**self._acquire_kwargs):
+            raise LockTimeoutError(self)
 
-            if lock_transactions:
-                self.db_state.active_connection = None
-                self.db_state.transaction_lock.release()
+        db_state = self.db_state
 
-            raise LockTimeoutError(self)
+        # No database locks => only the personal lock is needed
+        if db_state.lock is not None:
+            acquired_transaction_lock = False
 
-        try:
-            # If the connection is closed, an exception is thrown
-            in_transaction = self.in_transaction
-        except sqlite3.ProgrammingError:
-            in_transaction = False
+            if lock_transactions and db_state.active_connection is not self:
+                if not db_state.transaction_lock.acquire(**self._acquire_kwargs):
+                    self.personal_lock.release()
+                    raise LockTimeoutError(self)
+
+                db_state.active_connection = self
+                acquired_transaction_lock = True
 
-        self.was_in_transaction = in_transaction
+            if not db_state.lock.acquire(**self._acquire_kwargs):
+                if acquired_transaction_lock:
+                    db_state.active_connection = None
+                    db_state.transaction_lock.release()
+
+                self.personal_lock.release()
+                raise LockTimeoutError(self)
+
+        self.with_count += 1
+
+        if self._owner == ident:
+            self._nested.append(lock_transactions)
+        else:
+            self._owner = ident
+            self._owner_lock_transactions = lock_transactions
 
     def release(self, lock_transactions=None):
         """
             Release the connection locks.
 
-            :param lock_transactions: `bool`, release the transaction lock
-                                      (`self.lock_transactions` is the default value)
+            :param lock_transactions: ignored, the value used by the matching :any:`acquire` call
+                                      determines whether the transaction lock is released
         """
 
-        self.personal_lock.release()
+        if self._owner != get_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+
+        if self._nested:
+            lock_transactions = self._nested.pop()
+
+            # Matches a nested acquire() that didn't actually acquire anything
+            if lock_transactions is None:
+                return
+        else:
+            lock_transactions = self._owner_lock_transactions
+            self._owner = None
 
         self.with_count -= 1
 
-        if lock_transactions is None:
-            lock_transactions = self.lock_transactions
+        db_state = self.db_state
 
-        if not lock_transactions:
-            self.db_state.lock.release()
+        if db_state.lock is None:
+            self.personal_lock.release()
             return
 
-        try:
-            # If the connection is closed, an exception is thrown
-            in_transaction = self.in_transaction
-        except sqlite3.ProgrammingError:
-            in_transaction = False
-
-        # The transaction lock should be released only if:
-        # 1) the connection was previously in a transaction and now it isn't
-        # 2) the connection wasn't previously in a transaction and still isn't
-        if (self.was_in_transaction and not in_transaction) or not in_transaction:
-            if self.with_count == 0: # This is for nested with statements
-                self.db_state.active_connection = None
-                self.db_state.transaction_lock.release()
+        # The outermost call releases the transaction lock, even if only a nested call acquired it
+        if self.with_count == 0 and db_state.active_connection is self:
+            # The personal lock is still held, so no other thread could have closed the connection
+            in_transaction = False if self.closed else self.connection.in_transaction
 
-        self.db_state.lock.release()
+            # The transaction lock should be released only if the connection is not in a transaction
+            # (regardless of whether it was in one when the locks were acquired)
+            if not in_transaction:
+                db_state.active_connection = None
+                db_state.transaction_lock.release()
 
-    def __del__(self):
-        self.close()
+        db_state.lock.release()
+        self.personal_lock.release()
 
     def close(self):
         """Close the connection"""
@@ -429,45 +814,82 @@ class Connection(object):
         # Make sure no one minds the connection to be closed
         # This will help avoid MemoryError in other threads,
         # they will get sqlite3.ProgrammingError instead
-        if not self.personal_lock.acquire(timeout=self.lock_timeout):
+        if not self.personal_lock.acquire(**self._acquire_kwargs):
             raise LockTimeoutError(self)
 
         try:
             try:
-                if self.in_transaction:
+                # Only the connection holding the transaction lock may release it
+                if self.db_state.active_connection is self and self.connection.in_transaction:
                     self.db_state.active_connection = None
                     self.db_state.transaction_lock.release()
             except sqlite3.ProgrammingError:
                 pass
 
-            if self._cursor is not None and not self._cursor.closed:
-                self._cursor._cursor.close()
-                self._cursor.closed = True
+            for cursor in list(self._all_cursors):
+                if not cursor.closed:
+                    cursor._cursor.close()
+                    cursor.closed = True
 
-            if self.connection is not None:
-                self.connection.close()
+            if self._finalizer is not None:
+                self._finalizer()
 
             self.closed = True
         finally:
             self.personal_lock.release()
 
-    def execute(self, *args, **kwargs):
+    def execute(self, sql, parameters=None):
         """Analogous to :any:`sqlite3.Cursor.execute`"""
 
-        return self.cursor().execute(*args, **kwargs)
+        return self.cursor().execute(sql, parameters)
 
-    def executemany(self, *args, **kwargs):
+    def executemany(self, sql, seq_of_parameters):
         """Analogous to :any:`sqlite3.Cursor.executemany`"""
 
-        return self.cursor().executemany(*args, **kwargs)
+        return self.cursor().executemany(sql, seq_of_parameters)
 
     def executescript(self, *args, **kwargs):
         """Analogous to :any:`sqlite3.Cursor.executescript`"""
 
         return self.cursor().executescript(*args, **kwargs)
 
-    def commit(self):
-        """Analogous to :any:`sqlite3.Connection.commit`"""
+    def execute_batch(self, statements):
+        """Analogous to :any:`Cursor.execute_batch`"""
+
+        return self.cursor().execute_batch(statements)
+
+    def executemany_fast(self, sql, seq_of_parameters):
+        """Analogous to :any:`Cursor.executemany_fast`"""
+
+        return self.cursor().executemany_fast(sql, seq_of_parameters)
+
+    def commit(self, commit_async=False):
+        """Analogous to :any:`sqlite3.Connection.commit`
+
+           :param commit_async: If `True`, the commit will be done in a background thread
+                                (requires `check_same_thread=False`). Each database has one such thread,
+                                so the commits queue up behind each other (they are not merged together).
+                                Can't be used while the current thread holds the locks (e.g. in a `with` block),
+                                the commit would wait for them forever.
+           :returns: :any:`concurrent.futures.Future` if `commit_async` is `True`, otherwise `None`
+        """
+
+        if commit_async:
+            if self._check_same_thread:
+                raise S3MError("commit_async=True requires check_same_thread=False")
+
+            if self._owner == get_ident():
+                raise S3MError("commit_async=True can't be used while holding the locks")
+
+            db_state = self.db_state
+
+            if db_state.commit_executor is None:
+                with DICT_LOCK:
+                    if db_state.commit_executor is None:
+                        db_state.commit_executor = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=1, thread_name_prefix="s3m-commit")
+
+            return db_state.commit_executor.submit(self.commit)
 
         with self:
             self.connection.commit()
@@ -628,7 +1050,7 @@ def connect(path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=Fa
        :param lock_timeout: Maximum amount of time the connection is allowed to wait for a lock.
                             If the timeout i exceeded, :any:`LockTimeoutError` will be thrown.
                             -1 disables the timeout.
-       :param single_cursor_mode: Use only one cursor (default: `False`)
+       :param single_cursor_mode: Use only one cursor per thread (default: `False`)
        :param factory: Connection class (default: :any:`Connection`)
     """
 
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
 import sqlite3
 import sys
+import tempfile
 import threading
 import unittest
 
@@ -16,17 +18,21 @@ class S3MTestCase(unittest.TestCase):
         self.n_connections = 25
         self.db_path = "s3m_test.db"
 
-        try:
-            os.remove(self.db_path)
-        except FileNotFoundError:
-            pass
+        self.remove_db()
+
+    def remove_db(self):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.db_path + suffix)
+            except FileNotFoundError:
+                pass
 
     def insert_func(self, *args, **kwargs):
         conn = self.connect_db(*args, **kwargs)
         if conn.path == ":memory:":
             self.assertFalse(conn.path in s3m.DB_STATES)
         else:
-            self.assertIs(conn.db_state, s3m.DB_STATES[s3m.normalize_path(conn.path)].peek()[0])
+            self.assertIs(conn.db_state, s3m.DB_STATES[s3m.database_path(conn.path)].peek()[0])
 
         queries = ["CREATE TABLE IF NOT EXISTS a(id INTEGER)",
                    "BEGIN TRANSACTION",
@@ -183,10 +189,335 @@ class S3MTestCase(unittest.TestCase):
                 with conn:
                     conn.close()
 
-    def tearDown(self):
+    def test_symlink_swap(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            for name in ("r1", "r2"):
+                os.mkdir(os.path.join(directory, name))
+
+            link = os.path.join(directory, "cur")
+            path = os.path.join(link, "x.db")
+
+            os.symlink("r1", link)
+            self.connect_db(path).execute("CREATE TABLE a(id INTEGER)")
+
+            os.remove(link)
+            os.symlink("r2", link)
+
+            conn = self.connect_db(path)
+            self.assertEqual(conn.path, s3m.normalize_path(os.path.join(directory, "r2", "x.db")))
+            self.assertEqual(conn.execute("SELECT name FROM sqlite_master").fetchall(), [])
+            conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_uri(self):
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+
+        try:
+            for name in ("A", "B"):
+                os.mkdir(os.path.join(directory, name))
+
+            os.chdir(os.path.join(directory, "A"))
+            conn1 = self.connect_db("file:t.db", uri=True)
+            conn1.execute("CREATE TABLE in_A(id INTEGER)")
+
+            # The same file => the same state
+            conn2 = self.connect_db("t.db")
+            self.assertIs(conn2.db_state, conn1.db_state)
+            conn2.close()
+
+            os.chdir(os.path.join(directory, "B"))
+            conn3 = self.connect_db("file:t.db?mode=rwc", uri=True)
+            self.assertIsNot(conn3.db_state, conn1.db_state)
+            self.assertEqual(conn3.execute("SELECT name FROM sqlite_master").fetchall(), [])
+
+            conn1.close()
+            conn3.close()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+    def test_wal(self):
+        conn = self.connect_db()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+
+        conn = self.connect_db(":memory:")
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("memory",))
+
+        # SQLite doesn't switch in-memory databases, but doesn't raise either
+        conn = self.connect_db("file:s3m_test_wal?mode=memory&cache=shared", uri=True)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("memory",))
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone(), (2,))
+        self.assertFalse(conn.db_state.wal_enabled)
+
+    def test_wal_locked(self):
+        other = sqlite3.connect(self.db_path, isolation_level=None)
+        other.execute("CREATE TABLE a(id INTEGER)")
+
+        # Another process is reading the rollback journal database
+        other.execute("BEGIN")
+        other.execute("SELECT id FROM a").fetchall()
+
+        conn = self.connect_db()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("delete",))
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone(), (2,))
+        self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone(), (5000,))
+        self.assertFalse(conn.db_state.wal_enabled)
+        conn.close()
+
+        other.rollback()
+        other.close()
+
+        # The next connection tries again
+        conn = self.connect_db()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone(), (1,))
+
+    def test_read_only(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.commit()
+        conn.close()
+
+        conn = self.connect_db("file:%s?mode=ro" % (self.db_path,), uri=True)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ("delete",))
+        self.assertEqual(conn.execute("SELECT id FROM a").fetchall(), [])
+        conn.close()
+
+        conn = self.connect_db("file:%s?mode=ro" % (self.db_path,), uri=True, lock_timeout=0.01)
+
+        # The database is locked by another process
+        other = sqlite3.connect(self.db_path, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+
+        with self.assertRaises(s3m.LockTimeoutError):
+            conn.execute("SELECT id FROM a")
+
+        other.rollback()
+        other.close()
+
+    def test_connect_in_transaction(self):
+        conn1 = self.connect_db(lock_timeout=1)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        conn1.execute("BEGIN")
+        conn1.execute("INSERT INTO a VALUES(1)")
+
+        # Must not wait for the transaction of conn1
+        conn2 = self.connect_db(lock_timeout=1)
+
+        conn1.commit()
+
+        self.assertEqual(conn2.execute("SELECT id FROM a").fetchall(), [(1,)])
+
+    def test_busy_timeout(self):
+        conn = self.connect_db(lock_timeout=0.5)
+        self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone(), (500,))
+
+        conn = self.connect_db(lock_timeout=0.5, timeout=2)
+        self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone(), (2000,))
+
+        # sqlite3's default timeout is kept
+        conn = self.connect_db()
+        self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone(), (5000,))
+        self.assertEqual(str(s3m.LockTimeoutError(conn)), "Lock timeout exceeded")
+
+    def test_select_without_lock(self):
+        conn1 = self.connect_db(lock_timeout=0.01)
+        conn2 = self.connect_db(lock_timeout=0.01)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        conn1.execute("INSERT INTO a VALUES(1)")
+
+        result = []
+
+        def thread_func():
+            result.extend(conn2.execute("SELECT id FROM a").fetchall())
+
+        with conn1:
+            thread = threading.Thread(target=thread_func)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(result, [(1,)])
+
+    def test_single_cursor_mode(self):
+        conn = self.connect_db(":memory:", single_cursor_mode=True)
+
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.execute("INSERT INTO a VALUES(1)")
+
+        self.assertIs(conn.cursor(), conn.cursor())
+
+        cursors = []
+        thread = threading.Thread(target=lambda: cursors.append(conn.cursor()))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(cursors[0], conn.cursor())
+
+        self.assertEqual(conn.execute("SELECT id FROM a").fetchall(), [(1,)])
+
+        conn.close()
+        self.assertTrue(cursors[0].closed)
+        self.assertTrue(conn.cursor().closed)
+
+    def test_executemany_fast(self):
+        conn = self.connect_db()
+
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.executemany_fast("INSERT INTO a VALUES(?)", [(i,) for i in range(10)])
+
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(len(conn.execute("SELECT id FROM a").fetchall()), 10)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.executemany_fast("INSERT INTO b VALUES(?)", [(1,)])
+
+        self.assertFalse(conn.in_transaction)
+
+        statements = []
+        conn.connection.set_trace_callback(statements.append)
+        conn.executemany_fast("INSERT INTO a VALUES(?)", [(1,)])
+        self.assertEqual(statements[0], "BEGIN IMMEDIATE")
+
+        conn = self.connect_db(lock_transactions=False)
+        statements = []
+        conn.connection.set_trace_callback(statements.append)
+        conn.executemany_fast("INSERT INTO a VALUES(?)", [(1,)])
+        self.assertEqual(statements[0], "BEGIN")
+
+    def test_begin_immediate(self):
+        conn = self.connect_db(lock_timeout=0.05)
+        other = sqlite3.connect(self.db_path, isolation_level=None, timeout=0)
+
+        conn.execute("BEGIN")
+
+        # The write lock is taken right away, no one else can start writing
+        with self.assertRaises(sqlite3.OperationalError):
+            other.execute("BEGIN IMMEDIATE")
+
+        conn.rollback()
+
+        other.execute("BEGIN IMMEDIATE")
+
+        with self.assertRaises(s3m.LockTimeoutError):
+            conn.execute("BEGIN")
+
+        other.rollback()
+        other.close()
+
+    def test_journal_size_limit(self):
+        limit = s3m.JOURNAL_SIZE_LIMIT
+        s3m.JOURNAL_SIZE_LIMIT = 64 * 1024
+
         try:
-            os.remove(self.db_path)
-        except FileNotFoundError:
-            pass
+            conn = self.connect_db()
+        finally:
+            s3m.JOURNAL_SIZE_LIMIT = limit
+
+        self.assertEqual(conn.execute("PRAGMA journal_size_limit").fetchone(), (64 * 1024,))
+
+        conn.execute("CREATE TABLE a(data BLOB)")
+        conn.executemany_fast("INSERT INTO a VALUES(?)", [(bytes(1024),) for i in range(1000)])
+        self.assertGreater(os.path.getsize(self.db_path + "-wal"), 64 * 1024)
+
+        # The WAL file is truncated once it's restarted after a checkpoint
+        conn.execute("PRAGMA wal_checkpoint")
+        conn.execute("INSERT INTO a VALUES(NULL)")
+        self.assertLessEqual(os.path.getsize(self.db_path + "-wal"), 64 * 1024)
+
+    def test_commit_async(self):
+        conn = self.connect_db()
+
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO a VALUES(1)")
+
+        future = conn.commit(commit_async=True)
+        self.assertIsNone(future.result())
+
+        self.assertFalse(conn.in_transaction)
+
+        conn2 = self.connect_db()
+        self.assertEqual(conn2.execute("SELECT id FROM a").fetchall(), [(1,)])
+
+        # Each database has its own thread
+        conn3 = self.connect_db(":memory:")
+        conn3.commit(commit_async=True).result()
+        self.assertIsNotNone(conn3.db_state.commit_executor)
+        self.assertIsNot(conn3.db_state.commit_executor, conn.db_state.commit_executor)
+
+        # The commit would wait for the locks held by this thread
+        with conn:
+            with self.assertRaises(s3m.S3MError):
+                conn.commit(commit_async=True)
+
+        # sqlite3 would refuse to commit in another thread
+        with self.assertRaises(s3m.S3MError):
+            self.connect_db(check_same_thread=True).commit(commit_async=True)
+
+    def test_finalizer(self):
+        raw_connection = self.connect_db().connection
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            raw_connection.execute("SELECT 1")
+
+        raw_connection = self.connect_db(":memory:").connection
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            raw_connection.execute("SELECT 1")
+
+    def test_nested_acquire(self):
+        conn = self.connect_db()
+
+        with conn:
+            with conn:
+                conn.execute("CREATE TABLE a(id INTEGER)")
+                self.assertEqual(conn.with_count, 1)
+
+        self.assertEqual(conn.with_count, 0)
+        self.assertIsNone(conn.db_state.active_connection)
+
+        with self.assertRaises(RuntimeError):
+            conn.release()
+
+        conn.acquire(lock_transactions=False)
+        conn.acquire(lock_transactions=True)
+        conn.release(lock_transactions=False)
+        conn.release(lock_transactions=True)
+
+        self.assertEqual(conn.with_count, 0)
+        self.assertIsNone(conn.db_state.active_connection)
+        self.assertFalse(conn.db_state.transaction_lock.locked())
+
+    def test_execute_batch(self):
+        conn = self.connect_db()
+
+        conn.execute_batch(["CREATE TABLE a(id INTEGER)",
+                            "BEGIN TRANSACTION",
+                            "INSERT INTO a VALUES(1)",
+                            "INSERT INTO a VALUES(2)",
+                            "COMMIT"])
+
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute("SELECT id FROM a").fetchall(), [(1,), (2,)])
+
+        statements = []
+        conn.connection.set_trace_callback(statements.append)
+
+        conn.execute_batch(["BEGIN",
+                            "INSERT INTO a VALUES(3) -- trailing comment",
+                            "COMMIT"])
+
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute("SELECT id FROM a").fetchall(), [(1,), (2,), (3,)])
+        self.assertTrue(statements[0].startswith("BEGIN IMMEDIATE"))
+
+    def tearDown(self):
+        self.remove_db()
 
         self.assertEqual(len(s3m.DB_STATES), 0)